@@ -262,7 +262,7 @@ show_img(generated_image_example.squeeze())
 # ## Discriminator
 # 
 # 
-# The discriminator takes in an image with a corresponding digit label and assesses, whether the image is real or fake:
+# The discriminator takes in an image with a corresponding digit label and assesses, whether the image is real or fake. It outputs a raw score (logit) instead of a probability, as the sigmoid is applied by the loss function:
 
 # In[ ]:
 
@@ -290,8 +290,7 @@ class Discriminator(Model):
             nn.Flatten(),
             nn.Dropout(0.4),
                         
-            nn.Linear(512, 1),
-            nn.Sigmoid()
+            nn.Linear(512, 1)
         )
         
     def forward(self, img, label):
@@ -312,7 +311,7 @@ class Discriminator(Model):
 discriminator_example = Discriminator()
 
 prediction_example = discriminator_example.predict(generated_image_example, digit_label_example)
-print('Discriminator Prediction: %f' % prediction_example.item())
+print('Discriminator Prediction: %f' % torch.sigmoid(prediction_example).item())
 
 
 # ## Training
@@ -342,7 +341,7 @@ discriminator = Discriminator().to(dev)
 
 generator_optimizer = optim.Adam(generator.parameters(), lr=0.0002, betas=(0.5, 0.999))
 discriminator_optimizer = optim.Adam(discriminator.parameters(), lr=0.0002, betas=(0.5, 0.999))
-criterion = nn.BCELoss()
+criterion = nn.BCEWithLogitsLoss()
 
 
 # Now let's finally train our cGAN:
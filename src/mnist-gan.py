@@ -41,6 +41,9 @@
 # In[ ]:
 
 
+import contextlib
+import os
+
 import numpy as np
 import matplotlib.pyplot as plt
 get_ipython().run_line_magic('matplotlib', 'inline')
@@ -54,15 +57,24 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 
 import torchvision
 import torchvision.transforms as transforms
 
+# Let cuDNN benchmark and pick the fastest convolution algorithms for our fixed
+# input shapes, and allow TF32 tensor cores on Ampere and newer GPUs
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
 
 # In[ ]:
 
 
 BATCH_SIZE = 200
+HALF_BATCH = int(BATCH_SIZE/2)
 EPOCHS = 20
 
 # GAN configurations
@@ -71,6 +83,25 @@ REAL_LABEL = 1
 FAKE_LABEL = 0
 
 
+# The GAN can also be trained on multiple GPUs with `DistributedDataParallel` by launching the exported script with `torchrun` (see the README). Each process then trains a copy of the networks on its own GPU and its own batches, and the gradients are averaged across all processes. In a notebook, we'll simply train in a single process:
+
+# In[ ]:
+
+
+distributed = 'LOCAL_RANK' in os.environ
+local_rank = int(os.environ.get('LOCAL_RANK', 0))
+rank = int(os.environ.get('RANK', 0))
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+
+if distributed:
+    # Pin the process to its GPU before any NCCL collective runs
+    torch.cuda.set_device(local_rank)
+    dist.init_process_group('nccl')
+
+# Give every process its own random stream, so they train on different batches
+torch.manual_seed(torch.initial_seed() + rank)
+
+
 # ## Loading MNIST Dataset
 
 # We'll be using the MNIST dataset to train our GAN. It contains images of handwritten digits. Loading MNIST is trivial using `torchvision`.
@@ -89,11 +120,16 @@ transform = transforms.Compose([
 # In[ ]:
 
 
+# Only the first process downloads MNIST, the others wait for it instead of racing it
+if distributed and rank != 0:
+    dist.barrier()
 dataset = torchvision.datasets.MNIST(
-    root='./data', download=True, transform=transform
+    root='./data', download=(rank == 0), transform=transform
 )
+if distributed and rank == 0:
+    dist.barrier()
 dataloader = torch.utils.data.DataLoader(
-    dataset, batch_size=int(BATCH_SIZE/2), shuffle=True, num_workers=2
+    dataset, batch_size=HALF_BATCH, shuffle=True, num_workers=2
 )
 
 
@@ -105,7 +141,7 @@ dataloader = torch.utils.data.DataLoader(
 
 
 dataiter = iter(dataloader)
-images, labels = dataiter.next()
+images, labels = next(dataiter)
 
 
 # In[ ]:
@@ -129,13 +165,13 @@ print('Label: %s' % labels[0].item())
 
 # The generator creates new images by upsampling a random seed, the so-called latent space.
 # 
-# We'll create a helper function that creates a minibatch of latent spaces:
+# We'll create a helper function that creates a minibatch of latent spaces, sampled from a standard normal distribution. During training, the latent points are created directly on the GPU, so they don't need to be copied over from the CPU:
 
 # In[ ]:
 
 
-def generate_latent_points(latent_dim, n_samples):
-    return torch.rand(n_samples, latent_dim)
+def generate_latent_points(latent_dim, n_samples, device='cpu'):
+    return torch.randn(n_samples, latent_dim, device=device)
 
 
 # In[ ]:
@@ -148,7 +184,7 @@ show_img(img)
 
 # ## Model
 
-# The `Model` class will be used as a base for the `Generator` and `Discriminator` class. It mainly offers the `predict` method, to run the model without accumulating gradients, and the `train_on` method, used to train a model on a batch and backpropagate.
+# The `Model` class will be used as a base for the `Generator` and `Discriminator` class. It mainly offers the `predict` method, to run the model without accumulating gradients. During training, we'll call the compiled networks directly instead (see below).
 
 # In[ ]:
 
@@ -162,13 +198,6 @@ class Model(nn.Module):
     
     def predict(self, x):
         return self.model(x).detach()
-        
-    def train_on(self, x, y, criterion, optimizer):
-        output = self.model(x)
-        loss = criterion(output, y)
-        loss.backward()
-        optimizer.step()
-        return loss
 
 
 # ## Generator
@@ -187,7 +216,7 @@ class Reshape(nn.Module):
         return x.view(*self.shape)
 
 
-# The Generator takes a latent space as input and upsamples this seed to a random image of a digit:
+# The Generator takes a latent space as input and upsamples this seed to a random image of a digit. Each upsampling step uses a convolution producing 4x the channels, followed by a `PixelShuffle` rearranging these channels into an image of twice the size. Compared to a transposed convolution, this avoids checkerboard artifacts:
 
 # In[ ]:
 
@@ -197,24 +226,27 @@ class Generator(Model):
         super(Generator, self).__init__()
         self.model = nn.Sequential(
             # Pass the latent space through a fully-connected layer
-            nn.Linear(LATENT_DIM, 128*7*7),
+            # (no bias needed, as the following BatchNorm already adds one)
+            nn.Linear(LATENT_DIM, 128*7*7, bias=False),
             nn.BatchNorm1d(128*7*7),
-            nn.LeakyReLU(0.2),
+            nn.LeakyReLU(0.2, inplace=True),
             
             # Reshape 1D tensor to a 7x7 image
             Reshape((-1, 128, 7, 7)),
             
             # Upsample to 14x14
-            nn.ConvTranspose2d(128, 128, 4, stride=2),
+            nn.Conv2d(128, 128*4, 3, padding=1, bias=False),
+            nn.PixelShuffle(2),
             nn.BatchNorm2d(128),
-            nn.LeakyReLU(0.2),
+            nn.LeakyReLU(0.2, inplace=True),
             
             # Upsample to 28x28
-            nn.ConvTranspose2d(128, 128, 4, stride=2),
+            nn.Conv2d(128, 128*4, 3, padding=1, bias=False),
+            nn.PixelShuffle(2),
             nn.BatchNorm2d(128),
-            nn.LeakyReLU(0.2),
+            nn.LeakyReLU(0.2, inplace=True),
             
-            nn.Conv2d(128, 1, 7),
+            nn.Conv2d(128, 1, 7, padding=3),
             nn.Tanh()
         )
 
@@ -236,7 +268,7 @@ show_img(generated_image_example.squeeze())
 
 # ## Discriminator
 
-# The discriminator takes in an image an assesses, whether the image is real or fake
+# The discriminator takes in an image an assesses, whether the image is real or fake. It outputs a raw score (logit) instead of a probability, as the sigmoid is applied by the loss function. This is numerically more stable, especially when training with mixed precision
 
 # In[ ]:
 
@@ -246,16 +278,15 @@ class Discriminator(Model):
         super(Discriminator, self).__init__()
         self.model = nn.Sequential(
             nn.Conv2d(1, 64, 3, stride=2),
-            nn.LeakyReLU(0.2),
+            nn.LeakyReLU(0.2, inplace=True),
             nn.Dropout(p=0.4),
             
             nn.Conv2d(64, 64, 3, stride=2),
-            nn.LeakyReLU(0.2),
+            nn.LeakyReLU(0.2, inplace=True),
             nn.Dropout(p=0.4),
             
             nn.Flatten(),
-            nn.Linear(2304, 1),
-            nn.Sigmoid()
+            nn.Linear(2304, 1)
         )
 
 
@@ -269,37 +300,145 @@ class Discriminator(Model):
 discriminator_example = Discriminator()
 
 prediction_example = discriminator_example(generated_image_example)
-print('Discriminator Prediction: %f' % prediction_example.item())
+print('Discriminator Prediction: %f' % torch.sigmoid(prediction_example).item())
 
 
 # ## Training
 
-# First we'll try setting up pytorch to use a CUDA-capable GPU. If no GPU is detected, the GAN will be trained on CPU:
+# First we'll try setting up pytorch to use a CUDA-capable GPU. If no GPU is detected, the GAN will be trained on CPU. On a GPU, we'll train with automatic mixed precision (AMP), running most layers in float16 to make use of tensor cores:
 
 # In[ ]:
 
 
-dev = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+if distributed:
+    dev = torch.device('cuda', local_rank)
+else:
+    dev = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+use_amp = dev.type == 'cuda'
 print('Using device "%s" for training' % dev)
 
 
-# Next we'll create the networks and move them to our selected device:
+# MNIST is small enough to fit into GPU memory entirely. We'll load all training images onto our device once, so that batches can be sampled directly on the device, without any image decoding or copying during training. Instead of running the transformation above on every single image, we'll normalize the raw image data to [-1, 1] in one go. The images are stored in the channels-last memory format, which lets cuDNN use its faster NHWC convolutions:
 
 # In[ ]:
 
 
-generator = Generator().to(dev)
-discriminator = Discriminator().to(dev)
+all_imgs = (dataset.data.float() / 127.5 - 1).unsqueeze(1).to(dev, memory_format=torch.channels_last)
 
 
-# We'll also define the optimizers, used to train the networks, and our loss function:
+# Next we'll create the networks and move them to our selected device. When training on multiple GPUs, the networks are wrapped in `DistributedDataParallel`, which averages the gradients across processes while the backward pass is still running. `torch.compile` then fuses the small pointwise layers (BatchNorm, LeakyReLU, ...) into fewer kernels. On a single GPU, we'll additionally capture the training steps as CUDA graphs later on:
+
+# In[ ]:
+
+
+generator = Generator().to(dev, memory_format=torch.channels_last)
+discriminator = Discriminator().to(dev, memory_format=torch.channels_last)
+
+if distributed:
+    generator = DDP(generator, device_ids=[local_rank], bucket_cap_mb=25)
+    discriminator = DDP(discriminator, device_ids=[local_rank], bucket_cap_mb=25)
+
+generator = torch.compile(generator)
+discriminator = torch.compile(discriminator)
+
+
+# We'll also define the optimizers, used to train the networks, our loss function with its labels, and the gradient scalers, used to prevent small float16 gradients from underflowing:
 
 # In[ ]:
 
 
 generator_optimizer = optim.Adam(generator.parameters(), lr=0.0002, betas=(0.5, 0.999))
 discriminator_optimizer = optim.Adam(discriminator.parameters(), lr=0.0002, betas=(0.5, 0.999))
-criterion = nn.BCELoss()
+criterion = nn.BCEWithLogitsLoss()
+
+generator_scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+discriminator_scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+
+# Labels have a fixed shape, so we only need to create them once on our device
+real_labels = torch.full((HALF_BATCH, 1), REAL_LABEL, dtype=torch.float, device=dev)
+fake_labels = torch.full((HALF_BATCH, 1), FAKE_LABEL, dtype=torch.float, device=dev)
+labels_all = torch.cat((real_labels, fake_labels))
+
+
+# Each training iteration consists of a discriminator step and a generator step, which we'll wrap in functions. They run the forward and backward passes, while the optimizer steps are run separately in the training loop:
+
+# In[ ]:
+
+
+# Autocast's weight cache must be disabled when capturing CUDA graphs
+def autocast():
+    return torch.autocast(dev.type, dtype=torch.float16, enabled=use_amp, cache_enabled=False)
+
+def discriminator_step():
+    # MNIST training data, sampled from the images on our device
+    idx = torch.randint(0, len(all_imgs), (HALF_BATCH,), device=dev)
+    real_imgs = all_imgs[idx]
+    
+    # Fake training data
+    latent_points = generate_latent_points(LATENT_DIM, HALF_BATCH, device=dev)
+    with torch.no_grad(), autocast():
+        fake_imgs = generator(latent_points).contiguous(memory_format=torch.channels_last)
+
+    # Combine real and fake half-batches to one full batch 
+    images_all = torch.cat((real_imgs, fake_imgs))
+    
+    with autocast():
+        discriminator_loss = criterion(discriminator(images_all), labels_all)
+    discriminator_scaler.scale(discriminator_loss).backward()
+    return discriminator_loss
+
+def generator_step():
+    # Use a half-batch, so the generator trains on as many fake images as the discriminator
+    fake_batch = generate_latent_points(LATENT_DIM, HALF_BATCH, device=dev)
+
+    # Under DDP, skip all-reducing the discriminator's gradients of this step, as they're discarded anyway
+    discriminator_sync = discriminator.no_sync() if distributed else contextlib.nullcontext()
+
+    with autocast():
+        generator_imgs = generator(fake_batch)
+        with discriminator_sync:
+            discriminator_output = discriminator(generator_imgs)
+        generator_loss = criterion(discriminator_output, real_labels)
+    generator_scaler.scale(generator_loss).backward()
+    return generator_loss
+
+
+# Before training, we'll warm up both networks by running a few steps. This gives cuDNN the chance to benchmark its convolution algorithms and `torch.compile` to compile the models, so the first logged batches aren't slowed down. CUDA graphs require this warm-up to run on a side stream.
+# 
+# On a single GPU, every step launches the same long sequence of small kernels, so launching them can take as long as running them. After the warm-up, we'll capture both steps as CUDA graphs once, which can then be replayed with a single launch each. The optimizer steps stay outside of the graphs, as the gradient scalers need to check the gradients for infinities on the CPU:
+
+# In[ ]:
+
+
+use_graphs = dev.type == 'cuda' and not distributed
+
+def warmup(steps=3):
+    for _ in range(steps):
+        discriminator_step()
+        generator_step()
+
+if use_graphs:
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        warmup()
+    torch.cuda.current_stream().wait_stream(stream)
+else:
+    warmup()
+
+# Discard the warm-up gradients. When capturing, the captured backward passes
+# allocate the gradients anew, and every replay overwrites them
+discriminator_optimizer.zero_grad(set_to_none=True)
+generator_optimizer.zero_grad(set_to_none=True)
+
+if use_graphs:
+    discriminator_graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(discriminator_graph):
+        discriminator_loss = discriminator_step()
+
+    generator_graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(generator_graph):
+        generator_loss = generator_step()
 
 
 # Now let's finally train our GAN:
@@ -307,58 +446,61 @@ criterion = nn.BCELoss()
 # In[ ]:
 
 
+# Visualize the same latent points throughout training, to see how their digits evolve.
+# Under DDP, the unwrapped generator is used, as only the first process saves figures
+vis_latent = generate_latent_points(LATENT_DIM, 30, device=dev)
+vis_generator = generator.module if distributed else generator
+
+# Every process draws its own batches, so together they see the dataset once per epoch
+iterations = len(all_imgs) // (HALF_BATCH * world_size)
+
 for epoch in range(EPOCHS):
-    for i, data in enumerate(dataloader, 0):
+    for i in range(iterations):
         # ===========================
         # STEP 1: Train Discriminator
         # ===========================
-        
-        # MNIST training data
-        # data[0] are the images, data[1] are the labels (e.g. 1, 2, 3, 4, ...) that we don't need
-        real_imgs = data[0].to(dev)
-        real_labels = torch.zeros(int(BATCH_SIZE/2)).fill_(REAL_LABEL)
-        
-        # Fake training data
-        latent_points = generate_latent_points(LATENT_DIM, int(BATCH_SIZE/2)).to(dev)
-        fake_imgs = generator.predict(latent_points).detach()
-        fake_labels = torch.zeros(int(BATCH_SIZE/2)).fill_(FAKE_LABEL)
-
-        discriminator_optimizer.zero_grad()
-
-        # Combine real and fake half-batches to one full batch 
-        images_all = torch.cat((real_imgs, fake_imgs))
-        labels_all = torch.cat((real_labels, fake_labels)).unsqueeze(1).to(dev)
-        
-        discriminator_loss = discriminator.train_on(
-            images_all, labels_all, criterion, discriminator_optimizer
-        )
+        if use_graphs:
+            discriminator_graph.replay()
+        else:
+            discriminator_optimizer.zero_grad(set_to_none=True)
+            discriminator_loss = discriminator_step()
+        discriminator_scaler.step(discriminator_optimizer)
+        discriminator_scaler.update()
         
         # =======================
         # STEP 2: Train Generator
         # =======================
-        generator_optimizer.zero_grad()
-
-        fake_batch = generate_latent_points(LATENT_DIM, BATCH_SIZE).to(dev)
-        fake_batch_labels = torch.zeros(BATCH_SIZE).fill_(REAL_LABEL).unsqueeze(1).to(dev)
-
-        generator_imgs = generator(fake_batch)
-        generator_loss = criterion(discriminator(generator_imgs), fake_batch_labels)
-        generator_loss.backward()
-        generator_optimizer.step()
+        if use_graphs:
+            generator_graph.replay()
+        else:
+            generator_optimizer.zero_grad(set_to_none=True)
+            generator_loss = generator_step()
+        generator_scaler.step(generator_optimizer)
+        generator_scaler.update()
 
         # ===============================
         # STEP 3: Logging and Visualizing
         # ===============================
-        if i % 25 == 0:
+        # Only log and save figures in the first process
+        if i % 25 == 0 and rank == 0:
             print('Epoch: %.2i    Batch Number: %.3i / %.3i    Generator Loss: %.9f    Discriminator Loss: %.9f' %
-                 (epoch, i, len(dataloader), generator_loss.item(), discriminator_loss.item()))
-            # show_img(fake_imgs.to("cpu")[0].squeeze().detach())
+                 (epoch, i, iterations, generator_loss.item(), discriminator_loss.item()))
             
-            fig = plt.figure()
-            for a in range(30):
-                ax = fig.add_subplot(6, 6, a + 1)
-                plt.imshow(fake_imgs.to("cpu").detach()[a, 0, :, :], cmap='gray_r')
+            # inference_mode skips all autograd bookkeeping, and float16 halves the memory traffic
+            vis_generator.eval()
+            with torch.inference_mode(), torch.autocast(dev.type, dtype=torch.float16, enabled=use_amp):
+                vis_imgs = vis_generator(vis_latent)
+            vis_generator.train()
+            # show_img(vis_imgs.float().to("cpu")[0].squeeze())
             
-            plt.savefig('figs/gan/plot  epoch ' + '%02d' % epoch + '  batch ' + '%05d' % i + '.png', dpi=600)
-            plt.close()
+            # Assemble a grid of the images on the device and save it. The images are
+            # inverted to match the gray_r colormap used by show_img
+            torchvision.utils.save_image(
+                -vis_imgs.float(),
+                'figs/gan/plot  epoch ' + '%02d' % epoch + '  batch ' + '%05d' % i + '.png',
+                nrow=6, normalize=True, value_range=(-1, 1), pad_value=1
+            )
+
+if distributed:
+    dist.destroy_process_group()
 
@@ -1,5 +1,9 @@
 import argparse
 import os
+import shlex
+import shutil
+import subprocess
+import sys
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-f', '--figs', default='figs/gan',
@@ -17,8 +21,41 @@ Note: This program requires ffmpeg on your machine.
 """)
 
 args = parser.parse_args()
-command = "ffmpeg -framerate %i -pattern_type glob -i '%s*.png' -c:v libx264 %s" %\
-          (args.framerate, args.figs, args.out)
 
-print(command)
-os.system(command)
+if not shutil.which('ffmpeg'):
+    sys.exit('Error: ffmpeg was not found. Please install it from https://ffmpeg.org/')
+
+
+def encode(codec):
+    command = ['ffmpeg', '-framerate', str(args.framerate), '-pattern_type', 'glob',
+               '-i', os.path.join(args.figs, '*.png')] + codec + ['-y', args.out]
+
+    print(' '.join(shlex.quote(arg) for arg in command))
+    subprocess.run(command, check=True)
+
+
+# Settle the overwrite decision once, so every encoding attempt can pass -y
+if os.path.exists(args.out):
+    try:
+        answer = input("File '%s' already exists. Overwrite? [y/N] " % args.out)
+    except EOFError:
+        answer = ''
+    if answer.strip().lower() != 'y':
+        sys.exit('Not overwriting - exiting')
+
+# Encode on the GPU with NVENC if available, fall back to software encoding
+software = ['-c:v', 'libx264']
+nvenc = False
+if shutil.which('nvidia-smi'):
+    encoders = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                              capture_output=True, text=True).stdout
+    nvenc = 'h264_nvenc' in encoders
+
+if nvenc:
+    try:
+        encode(['-c:v', 'h264_nvenc', '-preset', 'p1'])
+    except subprocess.CalledProcessError:
+        print('NVENC encoding failed, falling back to libx264')
+        encode(software)
+else:
+    encode(software)